@@ -5,6 +5,8 @@ from gimpfu import *
 from struct import Struct
 from itertools import repeat
 from os.path import basename
+from binascii import hexlify
+from hashlib import sha1
 
 class StructEx(Struct):
     def pack_to_file(self, file, *args):
@@ -26,6 +28,11 @@ map_cpoint = StructEx("<hh")
 fpg_header = StructEx("<7sB")
 fpg_map_header = StructEx("LL32s12sLLL")
 
+# 6-bit DAC values <-> 8-bit colormap values (out of range values are clamped to 63)
+_pal_expand = bytes(bytearray([min(x,63)<<2|min(x,63)>>4 for x in range(256)]))
+_pal_reduce = bytes(bytearray([x>>2 for x in range(256)]))
+_pal_unit = [min(x,63)/63.0 for x in range(256)]
+
 def decode_str(raw_str, encoding="CP850"):
     return raw_str.partition('\0')[0].decode(encoding)
 
@@ -98,11 +105,30 @@ class Pal:
 
     @staticmethod
     def from_colormap(colormap):
-        colors = bytearray([ord(x)>>2 for x in colormap[:768]]).ljust(768,b'\0')
+        colors = bytearray(bytes(colormap[:768]).translate(_pal_reduce)).ljust(768,b'\0')
         return Pal(colors=colors)
 
     def as_colormap(self):
-        return bytes(bytearray([x<<2|x>>4 for x in self.colors]))
+        return bytes(self.colors).translate(_pal_expand)
+
+    @staticmethod
+    def from_rgb(colors):
+        """Builds a palette from a sequence of GIMP colors (r, g, b in 0..1)"""
+        colors = bytearray([int(round(x*63)) for c in colors[:256] for x in (c.r, c.g, c.b)])
+        return Pal(colors=colors.ljust(768,b'\0'))
+
+    def as_rgb(self):
+        """Returns the colors as a list of (r, g, b) tuples in 0..1"""
+        c = [_pal_unit[x] for x in self.colors]
+        return zip(c[0::3], c[1::3], c[2::3])
+
+    def color_names(self):
+        """Returns the colors as a list of '#rrggbb' strings"""
+        h = hexlify(self.as_colormap())
+        return ['#' + h[i:i+6] for i in range(0, len(h), 6)]
+
+    def content_hash(self):
+        return sha1(bytes(self.colors)).hexdigest()
 
 
 class Map:
@@ -356,24 +382,56 @@ if __name__=='__main__':
     def export_pal(palette, dirname, filename):
         from os.path import join
         num_colors, colors = pdb.gimp_palette_get_colors(palette)
-        def add_color_bin(a,c):
-            return a+chr(int(round(c.r*63)))+chr(int(round(c.g*63)))+chr(int(round(c.b*63)))
-        cols = reduce(add_color_bin, colors, b'')
-        pal = Pal(colors=cols[:768].ljust(768,b'\0'))
+        pal = Pal.from_rgb(colors)
         with open(join(dirname,filename), "wb") as f:
             pal.write(f)
 
+    PAL_CACHE_PARASITE = 'div-pal-cache'
+
+    def read_pal_cache():
+        # Maps PAL content hash -> name of the GIMP palette it was imported as
+        parasite = gimp.parasite_find(PAL_CACHE_PARASITE)
+        if parasite is None:
+            return {}
+        entries = (line.partition('\t') for line in parasite.data.split('\n'))
+        return dict((key, name) for key, sep, name in entries if sep)
+
+    def write_pal_cache(cache):
+        # Names that would break the line format are simply not cached
+        data = '\n'.join('%s\t%s' % (key, name) for key, name in cache.items()
+            if '\t' not in name and '\n' not in name)
+        gimp.parasite_attach(gimp.Parasite(PAL_CACHE_PARASITE, PARASITE_PERSISTENT, data))
+
+    def find_cached_pal(cache, key, pal):
+        name = cache.get(key)
+        if name is None:
+            return None
+        num_palettes, palettes = pdb.gimp_palettes_get_list('')
+        if name not in palettes:
+            del cache[key]
+            return None
+        # The palette may have been edited since it was imported
+        num_colors, colors = pdb.gimp_palette_get_colors(name)
+        if num_colors != 256 or Pal.from_rgb(colors).colors != pal.colors:
+            return None
+        return name
+
     def import_pal(palette, filename):
         from gimpcolor import RGB
         with open(filename,"rb") as f:
             pal = Pal.read(f)
-        name = pdb.gimp_palette_new(basename(filename))
-        pdb.gimp_palette_set_columns(name, 16)
-        for i in range(0, 768, 3):
-            r, g, b = iter(pal.colors[i:i+3])
-            colorname = "#%02x%02x%02x" % (r<<2|r>>4, g<<2|g>>4, b<<2|b>>4)
-            color = RGB(r/63.0, g/63.0, b/63.0)
-            pdb.gimp_palette_add_entry(name, colorname, color)
+        # Clamp out of range colors so they hash the same as what GIMP stores
+        pal = Pal.from_colormap(pal.as_colormap())
+        key = pal.content_hash()
+        cache = read_pal_cache()
+        name = find_cached_pal(cache, key, pal)
+        if name is None:
+            name = pdb.gimp_palette_new(basename(filename))
+            pdb.gimp_palette_set_columns(name, 16)
+            for colorname, rgb in zip(pal.color_names(), pal.as_rgb()):
+                pdb.gimp_palette_add_entry(name, colorname, RGB(*rgb))
+            cache[key] = name
+            write_pal_cache(cache)
         pdb.gimp_context_set_palette(name)
         return name
 